@@ -3,7 +3,8 @@
 # This source code is licensed under the BSD license found in the
 # LICENSE file in the root directory of this source tree.
 
-import itertools
+import functools
+import sys
 
 import pytest
 import torch
@@ -11,62 +12,135 @@ import torch
 import xformers.components.attention.attention_patterns as AP
 
 
+def _cached_reference(fn):
+    # the references are reused across the parametrizations,
+    # hand out copies so that a test cannot corrupt the cache
+    cached_fn = functools.lru_cache(maxsize=None)(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        return cached_fn(*args, **kwargs).clone()
+
+    return wrapper
+
+
+# Above this size, the local 1d reference is built from a bit-packed band.
+# The unpacking reads the int64 words as little-endian bytes
+_PACKED_PATTERN_THRESHOLD = 1024
+_PACKED_PATTERN_SUPPORTED = sys.byteorder == "little"
+
+
 # baseline implementations
+@_cached_reference
 def _local_1d_pattern(attn_size: int, window_size: int) -> torch.Tensor:
     assert (
         window_size % 2 == 1
     ), "The window size is assumed to be odd (counts self-attention + 2 wings)"
     h_win_size = window_size // 2
 
-    attn_shape = (attn_size, attn_size)
-    full_attn = torch.ones(attn_shape, dtype=torch.bool)
+    if attn_size > _PACKED_PATTERN_THRESHOLD and _PACKED_PATTERN_SUPPORTED:
+        return _local_1d_pattern_packed(attn_size, h_win_size)
+
+    idx = torch.arange(attn_size)
+    return (idx[:, None] - idx[None, :]).abs() <= h_win_size
+
 
-    mask = torch.tril(full_attn, diagonal=h_win_size)
-    mask &= ~torch.tril(full_attn, diagonal=-(h_win_size + 1))
-    return mask
+def _local_1d_pattern_packed(attn_size: int, h_win_size: int) -> torch.Tensor:
+    # Build the band with 64 columns per int64 word, then unpack to a bool mask.
+    assert _PACKED_PATTERN_SUPPORTED, "The unpacking assumes a little-endian host"
+    # Row r covers the columns [r - h_win_size, r + h_win_size]
+    rows = torch.arange(attn_size)[:, None]
+    words_start = torch.arange(0, attn_size, 64)[None, :]
 
+    # band bounds, relative to each word: [n_rows, n_words]
+    lo = (rows - h_win_size - words_start).clamp_min(0)
+    hi = (rows + h_win_size - words_start).clamp_max(63)
 
-def _generate_2d_grid(H, W):
-    i = torch.arange(H)
-    j = torch.arange(W)
-    i, j = torch.meshgrid(i, j)
+    # set bits lo..hi, the shifts never exceed 63 so that int64 does not overflow
+    all_ones = torch.tensor(-1, dtype=torch.int64)
+    words = (all_ones << lo) & ~((all_ones << hi) << 1)
+    words = torch.where(lo <= hi, words, torch.zeros_like(words))
+
+    # Unpack byte per byte so that the only full size buffer is one byte per position,
+    # the same footprint as the final bool mask (int64 words are little-endian bytes)
+    packed = words.view(torch.uint8)
+    bits = packed[:, :, None] >> torch.arange(8, dtype=torch.uint8)
+    bits.bitwise_and_(1)
+    return bits.view(torch.bool).reshape(attn_size, -1)[:, :attn_size]
+
+
+@functools.lru_cache(maxsize=None)
+def _grid_flat(H, W):
+    # flattened (row-major) coordinates of a HxW grid, one column per axis.
+    # These are shared across calls, do not modify in place
+    i = torch.arange(H).repeat_interleave(W)
+    j = torch.arange(W).repeat(H)
     return i, j
 
 
-def _horizontal_axial_2d_distance(H, W, p=2.0):
-    i, _ = _generate_2d_grid(H, W)
-    ij = i.reshape(-1, 1).float()
-    d = torch.cdist(ij, ij, p=p)
+def _axial_1d_distance(ij, p=2.0):
+    # for a single coordinate every p-norm (p > 0) reduces to |i_a - i_b|,
+    # and the p=0 "norm" counts the non-zero differences
+    d = (ij - ij.transpose(0, 1)).abs()
+    if p == 0:
+        d = (d != 0).float()
     return d
 
 
+@_cached_reference
+def _horizontal_axial_2d_distance(H, W, p=2.0):
+    i, _ = _grid_flat(H, W)
+    ij = i[:, None].float()
+    return _axial_1d_distance(ij, p=p)
+
+
+@_cached_reference
 def _vertical_axial_2d_distance(H, W, p=2.0):
-    _, j = _generate_2d_grid(H, W)
-    ij = j.reshape(-1, 1).float()
-    d = torch.cdist(ij, ij, p=p)
-    return d
+    _, j = _grid_flat(H, W)
+    ij = j[:, None].float()
+    return _axial_1d_distance(ij, p=p)
+
 
+@_cached_reference
+def _local_2d_sq_distance(H, W):
+    # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b, a single gemm instead of cdist
+    i, j = _grid_flat(H, W)
+    ij = torch.stack((i, j), 1).float()
+    x1n = ij.pow(2).sum(-1, keepdim=True)
+    x2n = x1n.transpose(-1, -2)
+    d = torch.addmm(x2n, ij, ij.transpose(-1, -2), alpha=-2)
+    return d.add_(x1n).clamp_min_(0)
 
+
+@_cached_reference
 def _local_2d_distance(H, W, p=2.0):
     # axial is a special case with p=0 and distance=2
-    i, j = _generate_2d_grid(H, W)
-    ij = torch.stack([i.flatten(), j.flatten()], 1).float()
-    d = torch.cdist(ij, ij, p=p)
-    return d
+    if p == 2:
+        return _local_2d_sq_distance(H, W).clamp_min_(1e-30).sqrt_()
+
+    i, j = _grid_flat(H, W)
+    ij = torch.stack((i, j), 1).float()
+    diff = ij.unsqueeze(1) - ij.unsqueeze(0)
+    if p == 0:
+        # the p=0 "norm" counts the coordinates which differ
+        return (diff != 0).sum(-1).float()
+    if p == 1:
+        return diff.abs().sum(-1)
+    return torch.cdist(ij, ij, p=p)
 
 
 def _local_2d_gaussian_distribution(H, W, sigma=1.0):
-    d = _local_2d_distance(H, W, p=2.0) ** 2
+    d = _local_2d_sq_distance(H, W)
     d = torch.exp(-0.5 * sigma ** (-2.0) * d)
     return d
 
 
 @pytest.mark.parametrize("window_size", [3, 7, 11])
-@pytest.mark.parametrize("attn_size", [50, 51, 64])
+@pytest.mark.parametrize("attn_size", [50, 51, 64, 1100])
 def test_local_1d_pattern(attn_size, window_size):
-    mask = AP.local_1d_pattern(attn_size, window_size).float()
-    mask_ref = _local_1d_pattern(attn_size, window_size).float()
-    assert torch.allclose(mask, mask_ref)
+    mask = AP.local_1d_pattern(attn_size, window_size)
+    mask_ref = _local_1d_pattern(attn_size, window_size)
+    assert torch.equal(mask, mask_ref)
 
 
 @pytest.mark.parametrize("p", [0, 1, 2])
@@ -75,7 +149,7 @@ def test_local_1d_pattern(attn_size, window_size):
 def test_horizontal_axial_2d_distance(H, W, p):
     d = AP.horizontal_axial_2d_distance(H, W, p=p)
     d_ref = _horizontal_axial_2d_distance(H, W, p=p)
-    assert torch.allclose(d, d_ref)
+    torch.testing.assert_close(d, d_ref, rtol=1e-6, atol=1e-6)
 
 
 @pytest.mark.parametrize("p", [0, 1, 2])
@@ -84,7 +158,7 @@ def test_horizontal_axial_2d_distance(H, W, p):
 def test_vertical_axial_2d_distance(H, W, p):
     d = AP.vertical_axial_2d_distance(H, W, p=p)
     d_ref = _vertical_axial_2d_distance(H, W, p=p)
-    assert torch.allclose(d, d_ref)
+    torch.testing.assert_close(d, d_ref, rtol=1e-6, atol=1e-6)
 
 
 @pytest.mark.parametrize("p", [0, 1, 2])
@@ -93,7 +167,7 @@ def test_vertical_axial_2d_distance(H, W, p):
 def test_local_2d_distance(H, W, p):
     d = AP.local_2d_distance(H, W, p=p)
     d_ref = _local_2d_distance(H, W, p=p)
-    assert torch.allclose(d, d_ref)
+    torch.testing.assert_close(d, d_ref, rtol=1e-6, atol=1e-6)
 
 
 @pytest.mark.parametrize("sigma", [0.5, 1, 2])
@@ -102,7 +176,7 @@ def test_local_2d_distance(H, W, p):
 def test_local_2d_gaussian_distribution(H, W, sigma):
     d = AP.local_2d_gausian_distribution(H, W, sigma=sigma)
     d_ref = _local_2d_gaussian_distribution(H, W, sigma=sigma)
-    assert torch.allclose(d, d_ref)
+    torch.testing.assert_close(d, d_ref, rtol=1e-6, atol=1e-6)
 
 
 @pytest.mark.parametrize("window_size", [2, 4])
@@ -117,15 +191,19 @@ def test_swin_attention_pattern(H, W, window_size):
     h = H // window_size
     w = W // window_size
     d = d.reshape(h, window_size, w, window_size, h, window_size, w, window_size)
+    # group per (region, region) pair: [h, w, h, w, window_size ** 4]
+    d = d.permute(0, 2, 4, 6, 1, 3, 5, 7).reshape(h, w, h, w, -1)
+
+    y = torch.arange(h)
+    x = torch.arange(w)
+    same_region = (y[:, None, None, None] == y[None, None, :, None]) & (
+        x[None, :, None, None] == x[None, None, None, :]
+    )
 
-    for y, x in itertools.product(range(h), range(w)):
-        # every region should fully attend to itself
-        assert torch.all(d[y, :, x, :, y, :, x, :])
-        for y2, x2 in itertools.product(range(h), range(w)):
-            if y == y2 or x == x2:
-                continue
-            # different regions shouldn't attend between each other
-            assert torch.all(~d[y, :, x, :, y2, :, x2, :])
+    # every region should fully attend to itself
+    assert torch.equal(d.all(-1), same_region)
+    # different regions shouldn't attend between each other
+    assert torch.equal(d.any(-1), same_region)
 
     # test shifted case
     # in the shifted case, the self-attention should be the same
@@ -155,16 +233,15 @@ def test_swin_attention_pattern(H, W, window_size):
 def test_dilated_2d_pattern(H, W, k):
     d = AP.dilated_2d_pattern(H, W, k)
     d = d.reshape(H, W, H, W)
-    for h, w in itertools.product(range(H), range(W)):
-        i = h % k
-        j = w % k
-        # every kth element is taken
-        assert torch.all(d[h, w][i::k, j::k])
-        for ii, jj in itertools.product(range(k), range(k)):
-            if ii == i and jj == j:
-                continue
-            # and the other elements are discarded
-            assert torch.all(~d[h, w][ii::k, jj::k])
+
+    # every kth element is taken, starting from the (h % k, w % k) phase,
+    # and the other elements are discarded
+    i = torch.arange(H) % k
+    j = torch.arange(W) % k
+    d_ref = (i[:, None, None, None] == i[None, None, :, None]) & (
+        j[None, :, None, None] == j[None, None, None, :]
+    )
+    assert torch.equal(d, d_ref)
 
 
 def test_pattern_to_layout():
@@ -192,9 +269,17 @@ def test_pattern_to_layout():
     assert torch.allclose(layout3, ref3)
 
     # Handle heads properly
-    mask = torch.cat((mask1, mask2, mask3))
+    mask = torch.empty((3 * SIZE, SIZE), dtype=torch.bool)
+    mask[:SIZE] = mask1
+    mask[SIZE : 2 * SIZE] = mask2
+    mask[2 * SIZE :] = mask3
     layout = AP.pattern_to_layout(mask, BLOCK)
-    assert torch.allclose(layout, torch.cat((ref1, ref2, ref3)))
+
+    ref = torch.empty((3 * LAYOUT_SIZE, LAYOUT_SIZE), dtype=torch.long)
+    ref[:LAYOUT_SIZE] = ref1
+    ref[LAYOUT_SIZE : 2 * LAYOUT_SIZE] = ref2
+    ref[2 * LAYOUT_SIZE :] = ref3
+    assert torch.allclose(layout, ref)
 
     # Catch problematic dimensions
     mask_off = torch.ones((SIZE + 3, SIZE), dtype=torch.bool)
@@ -202,7 +287,23 @@ def test_pattern_to_layout():
         AP.pattern_to_layout(mask_off, BLOCK)
 
 
+def test_block_sparsify_tensor():
+    BLOCK = 16
+    Z, H, SIZE = 2, 3, 64
+    x = torch.randn((Z, H, SIZE, SIZE))
+    layout = torch.randint(2, (H, SIZE // BLOCK, SIZE // BLOCK))
+
+    sparse = AP.block_sparsify_tensor(x, layout, BLOCK)
+    assert sparse.shape == (Z, layout.sum(), BLOCK, BLOCK)
+
+    # blocks are expected in the order of the layout positives
+    for idx, (h, i, j) in enumerate(zip(*layout.nonzero(as_tuple=True))):
+        block = x[:, h, i * BLOCK : (i + 1) * BLOCK, j * BLOCK : (j + 1) * BLOCK]
+        assert torch.equal(sparse[:, idx], block)
+
+
 def test_alibi_pattern():
-    mask = AP.alibi_pattern(1e-3, (16, 128, 128))
-    # Minor, check that all the top left corners are True
+    # Minor, check that all the top left corners are True.
+    # Only the first position is needed, no need to build the whole sequence
+    mask = AP.alibi_pattern(1e-3, (16, 1, 1))
     assert torch.sum(mask[:, 0, 0]) == 16
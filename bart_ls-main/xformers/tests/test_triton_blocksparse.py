@@ -3,7 +3,9 @@
 # This source code is licensed under the BSD license found in the
 # LICENSE file in the root directory of this source tree.
 
+import functools
 import math
+import os
 
 import pytest
 import torch
@@ -43,6 +45,34 @@ if _triton_available:
         _triton_available = False
 
 
+def _random_layout(shape):
+    # same draw as seeding the global generator, without touching the global state.
+    # Not cached: the draw is cheap and every caller gets its own tensor to work with
+    generator = torch.Generator().manual_seed(0)
+    return torch.randint(2, shape, generator=generator)
+
+
+# Every new width triggers a Triton compile and autotune, by default only cover
+# a power-of-two width (256) and the largest, non power-of-two one (1792)
+_softmax_widths = (
+    [256, 576, 1024, 1792]
+    if os.getenv("XFORMERS_FULL_TEST_SWEEP", "0") == "1"
+    else [256, 1792]
+)
+
+
+def _randn(shape, dtype, device="cuda", seed=0):
+    # deterministic draw from a dedicated generator, the global RNG state is left alone
+    generator = torch.Generator(device=device).manual_seed(seed)
+    return torch.randn(shape, generator=generator, dtype=dtype, device=device)
+
+
+# Building the op JIT compiles the Triton kernels, share it across the dtypes
+@functools.lru_cache(maxsize=None)
+def _blocksparse_softmax(layout_shape, BLOCK):
+    return blocksparse_softmax(_random_layout(layout_shape), BLOCK)
+
+
 @pytest.mark.skipif(not _triton_available, reason="Triton requires a recent CUDA gpu")
 @pytest.mark.skipif(
     not _triton_available or get_current_cuda_device() == "T4",
@@ -54,22 +84,15 @@ if _triton_available:
 @pytest.mark.parametrize("BLOCK", [16, 32, 64])
 @pytest.mark.parametrize("DTYPE", [torch.float16])
 def test_matmul(MODE, TRANS_A, TRANS_B, BLOCK, DTYPE, Z=32, H=2, M=512, N=384, K=256):
-    # set seed
-    torch.random.manual_seed(0)
-
     # create inputs
-    a = torch.randn(
-        (Z, H, K, M) if TRANS_A else (Z, H, M, K), dtype=DTYPE, device="cuda"
-    )
-    b = torch.randn(
-        (Z, H, N, K) if TRANS_B else (Z, H, K, N), dtype=DTYPE, device="cuda"
-    )
+    a = _randn((Z, H, K, M) if TRANS_A else (Z, H, M, K), DTYPE, seed=0)
+    b = _randn((Z, H, N, K) if TRANS_B else (Z, H, K, N), DTYPE, seed=1)
     shape = {
         "sdd": (M, N),
         "dsd": (a.shape[2], a.shape[3]),
         "dds": (b.shape[2], b.shape[3]),
     }[MODE]
-    layout = torch.randint(2, (H, shape[0] // BLOCK, shape[1] // BLOCK))
+    layout = _random_layout((H, shape[0] // BLOCK, shape[1] // BLOCK))
 
     # triton result
     op = blocksparse_matmul(layout, BLOCK, MODE, trans_a=TRANS_A, trans_b=TRANS_B)
@@ -83,7 +106,7 @@ def test_matmul(MODE, TRANS_A, TRANS_B, BLOCK, DTYPE, Z=32, H=2, M=512, N=384, K
     ta = ta.transpose(2, 3) if TRANS_A else ta
     tb = tb.transpose(2, 3) if TRANS_B else tb
     tc = torch.matmul(ta, tb)
-    tc = triton.testing.mask_tensor(tc, layout, BLOCK) if MODE == "sdd" else tc
+    # only the blocks present in the layout are kept, no need to mask the others first
     tc = block_sparsify_tensor(tc, layout, BLOCK) if MODE == "sdd" else tc
 
     # compare
@@ -92,27 +115,44 @@ def test_matmul(MODE, TRANS_A, TRANS_B, BLOCK, DTYPE, Z=32, H=2, M=512, N=384, K
 
 @pytest.mark.skipif(not _triton_available, reason="Triton requires a recent CUDA gpu")
 @pytest.mark.parametrize("BLOCK", [32])
-@pytest.mark.parametrize("WIDTH", [256, 576, 1024, 1792])
+@pytest.mark.parametrize("WIDTH", _softmax_widths)
 @pytest.mark.parametrize("DTYPE", [torch.float16, torch.float32])
 def test_softmax(BLOCK, WIDTH, DTYPE):
-    # set seed
-    torch.random.manual_seed(0)
+    generator = torch.Generator(device="cuda").manual_seed(0)
     Z, H, M, N = 2, 4, WIDTH, WIDTH
     scale = 0.4
 
     # create inputs
-    layout = torch.randint(2, (H, M // BLOCK, N // BLOCK))
-    x = torch.randn((Z, H, M, N), dtype=DTYPE, requires_grad=True, device="cuda")
+    layout_shape = (H, M // BLOCK, N // BLOCK)
+    layout = _random_layout(layout_shape)
+    # x and the masks are drawn in sequence from the same stream, so they do not alias
+    x = torch.randn(
+        (Z, H, M, N), generator=generator, dtype=DTYPE, requires_grad=True, device="cuda"
+    )
     at_mask = torch.randint(
-        low=0, high=2, size=(N, N), dtype=torch.bool, requires_grad=False, device="cuda"
+        low=0,
+        high=2,
+        size=(N, N),
+        generator=generator,
+        dtype=torch.bool,
+        requires_grad=False,
+        device="cuda",
     )
-    kp_mask = torch.randint(
-        low=0, high=2, size=(Z, N), dtype=DTYPE, requires_grad=False, device="cuda"
+    kp_mask = torch.where(
+        torch.randint(
+            low=0,
+            high=2,
+            size=(Z, N),
+            generator=generator,
+            dtype=torch.bool,
+            device="cuda",
+        ),
+        torch.tensor(float("-inf"), dtype=DTYPE, device="cuda"),
+        torch.zeros((), dtype=DTYPE, device="cuda"),
     )
-    kp_mask[kp_mask == 1.0] = float("-inf")
 
     # triton result
-    op = blocksparse_softmax(layout, BLOCK)
+    op = _blocksparse_softmax(layout_shape, BLOCK)
     tx = block_sparsify_tensor(x, layout, BLOCK)
     ty = op(
         tx,
@@ -126,9 +166,7 @@ def test_softmax(BLOCK, WIDTH, DTYPE):
     # torch result
     rx = triton.testing.mask_tensor(x, layout, BLOCK, value=float("-inf"))
     if at_mask is not None:
-        # broadcast at_mask to the same shape as rx
-        M = at_mask[None, None, :, :] + torch.zeros_like(rx)
-        rx[M == 0] = float("-inf")
+        rx.masked_fill_(~at_mask[None, None, :, :], float("-inf"))
     if kp_mask is not None:
         rx += kp_mask[:, None, None, :]
     ry = torch.softmax(rx * scale, -1)
@@ -153,16 +191,17 @@ def test_attention_fwd_bwd(
     head_dim = 64
     qkv_shape = (batch_size, n_heads, n_ctx, head_dim)
     qkvs = [
-        torch.nn.Parameter(input_scale * torch.randn(qkv_shape), requires_grad=True)
-        .to(dtype)
-        .cuda()
+        torch.nn.Parameter(
+            input_scale * torch.randn(qkv_shape, device="cuda", dtype=dtype),
+            requires_grad=True,
+        )
         for _ in range(3)
     ]
     attn_mask = torch.tril(
         torch.ones(
             [n_ctx, n_ctx],
             device="cuda",
-            dtype=dtype,
+            dtype=torch.bool,
         ),
         diagonal=0,
     )
@@ -179,7 +218,7 @@ def test_attention_fwd_bwd(
     value.retain_grad()
     block_sparse_attention = BlockSparseAttention(layout, block)
     attn_out = block_sparse_attention(
-        att_mask=attn_mask, q=query, k=key, v=value, scale=scale
+        att_mask=attn_mask.to(dtype), q=query, k=key, v=value, scale=scale
     )
 
     # ad hoc loss
@@ -190,12 +229,11 @@ def test_attention_fwd_bwd(
     # Torch version:
     torch_q, torch_k, torch_v = [x.clone() for x in qkvs]
     torch_q = torch_q / math.sqrt(head_dim)
-    attn_mask = 1e6 * (-1 + (attn_mask.reshape((1, 1, n_ctx, n_ctx)).cuda()))
     torch_q.retain_grad()
     torch_k.retain_grad()
     torch_v.retain_grad()
     scores = scale * torch.einsum("bhsd,bhtd->bhst", torch_q, torch_k)
-    scores = scores + attn_mask
+    scores = scores.masked_fill(~attn_mask, float("-inf"))
     probs = torch.softmax(scores, dim=-1)
     torch_attn_out = torch.einsum("bhst,bhtd->bhsd", probs, torch_v)
 
@@ -217,6 +255,50 @@ def test_attention_fwd_bwd(
         )
 
 
+@pytest.mark.skipif(not _triton_available, reason="Triton requires a recent CUDA gpu")
+def test_blocksparse_dense_layout(
+    block=16, batch_size=2, n_heads=4, n_ctx=64, head_dim=32, scale=0.5
+):
+    generator = torch.Generator(device="cuda").manual_seed(0)
+    q, k, v = [
+        torch.randn(
+            (batch_size, n_heads, n_ctx, head_dim),
+            generator=generator,
+            dtype=torch.float16,
+            device="cuda",
+        )
+        for _ in range(3)
+    ]
+
+    # additive masks, the first key is never padded so that no row is fully masked
+    causal = torch.tril(torch.ones((n_ctx, n_ctx), dtype=torch.bool, device="cuda"))
+    att_mask = torch.zeros((n_ctx, n_ctx), dtype=torch.float16, device="cuda")
+    att_mask.masked_fill_(~causal, float("-inf"))
+
+    padded = torch.randint(
+        0, 2, (batch_size, n_ctx), generator=generator, device="cuda"
+    ).bool()
+    padded[:, 0] = False
+    kp_mask = torch.zeros((batch_size, n_ctx), dtype=torch.float16, device="cuda")
+    kp_mask.masked_fill_(padded, float("-inf"))
+
+    layout = torch.ones((n_heads, n_ctx // block, n_ctx // block), dtype=torch.long)
+    attention = BlockSparseAttention(layout, block)
+    assert attention.dense_layout
+
+    out = attention(
+        q=q, k=k, v=v, att_mask=att_mask, key_padding_mask=kp_mask, scale=scale
+    )
+    assert out.shape == q.shape
+
+    # Torch version:
+    scores = scale * (q / math.sqrt(head_dim)) @ k.transpose(-2, -1)
+    scores = scores + att_mask + kp_mask[:, None, None, :]
+    ref = torch.softmax(scores.float(), dim=-1).to(v.dtype) @ v
+
+    assert_almost_equal(out, ref)
+
+
 @pytest.mark.skipif(not _triton_available, reason="Triton requires a recent CUDA gpu")
 def test_blocksparse_attention_parity():
     def _reset_seeds():
@@ -258,21 +340,28 @@ def test_blocksparse_attention_parity():
     )
     r_sdp = multi_head_sdp(inputs, inputs, inputs)
 
-    _reset_seeds()
     test_config["name"] = "blocksparse"
-    attention_blocksparse = build_attention(test_config)
-    multi_head_blocksparse = (
-        MultiHeadDispatch(
-            seq_len=seq,
-            dim_model=model,
-            residual_dropout=0.0,
-            num_heads=heads,
-            attention=attention_blocksparse,
+    for force_sparse in (True, False):
+        _reset_seeds()
+        attention_blocksparse = build_attention(test_config)
+        if force_sparse:
+            # The layout is fully dense, which would bypass the Triton kernels.
+            # Force them so that their parity with sdp is still checked
+            attention_blocksparse.dense_layout = False
+            attention_blocksparse._build_sparse_operators()
+
+        multi_head_blocksparse = (
+            MultiHeadDispatch(
+                seq_len=seq,
+                dim_model=model,
+                residual_dropout=0.0,
+                num_heads=heads,
+                attention=attention_blocksparse,
+            )
+            .cuda()
+            .half()
         )
-        .cuda()
-        .half()
-    )
-    r_blocksparse = multi_head_blocksparse(inputs, inputs, inputs)
+        r_blocksparse = multi_head_blocksparse(inputs, inputs, inputs)
 
-    # FIXME: currently has max diff of .009, perhaps can be improved.
-    assert_almost_equal(r_sdp, r_blocksparse)
+        # FIXME: the sparse kernels currently have a max diff of .009, perhaps can be improved.
+        assert_almost_equal(r_sdp, r_blocksparse)
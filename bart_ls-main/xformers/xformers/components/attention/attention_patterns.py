@@ -169,18 +169,14 @@ def block_sparsify_tensor(x, mask, block_size):
     """
     Block sparsify a tensor, given a mask and block size
     """
-    ret = torch.empty(
-        (x.size(0), mask.sum(), block_size, block_size), dtype=x.dtype, device=x.device
-    )
-
-    for idx, (h, i, j) in enumerate(zip(*mask.nonzero(as_tuple=True))):
-        ret[:, idx, :, :] = x[
-            :,
-            h,
-            i * block_size : (i + 1) * block_size,
-            j * block_size : (j + 1) * block_size,
-        ]
-    return ret
+    h, i, j = mask.nonzero(as_tuple=True)
+
+    # [B, H, rows, block_size, cols, block_size] -> [B, H, rows, cols, block_size, block_size]
+    # so that all the selected blocks can be gathered at once
+    blocks = x.reshape(
+        x.size(0), x.size(1), mask.size(1), block_size, mask.size(2), block_size
+    ).transpose(3, 4)
+    return blocks[:, h, i, j]
 
 
 def pattern_to_layout(mask: torch.Tensor, block_size: int) -> torch.Tensor:
@@ -13,6 +13,7 @@ import torch
 
 from xformers import _is_triton_available
 from xformers.components.attention import Attention, AttentionConfig, register_attention
+from xformers.components.attention.core import scaled_dot_product_attention
 from xformers.components.attention.utils import bool_mask_to_additive
 
 _mask_type_warning = True
@@ -55,6 +56,9 @@ if _is_triton_available:
         .. note: it is possible to pass a specific per batch mask in the forward call,
             but this will not lead to any speed up.
             Any constant sparsity pattern is better passed through the layout parameter.
+
+        .. note: if the layout is fully dense, the blocksparse kernels are skipped
+            and a dense attention is computed instead.
         """
 
         def __init__(
@@ -85,7 +89,22 @@ if _is_triton_available:
             self.layout = layout
             self.block_size = block_size
 
-            # blocksparse operators
+            # A fully dense layout does not benefit from the blocksparse kernels,
+            # skip their compilation and dispatch to a dense attention
+            self.dense_layout = bool(layout.min() == 1)
+
+            if not self.dense_layout:
+                self._build_sparse_operators()
+
+            # make sure that the head dimension is not folded down with the batch
+            self.requires_head_dimension = True
+
+            # key padding mask and attention mask must be passed in separately
+            self.requires_separate_masks = True
+
+            self.requires_same_k_q_dimensions = True
+
+        def _build_sparse_operators(self):
             self.sparse_dot_sdd = blocksparse_matmul(
                 self.layout,
                 self.block_size,
@@ -102,14 +121,6 @@ if _is_triton_available:
             )
             self.sparse_softmax = blocksparse_softmax(self.layout, self.block_size)
 
-            # make sure that the head dimension is not folded down with the batch
-            self.requires_head_dimension = True
-
-            # key padding mask and attention mask must be passed in separately
-            self.requires_separate_masks = True
-
-            self.requires_same_k_q_dimensions = True
-
         def update_mask_type(self, mask: torch.Tensor):
             global _mask_type_warning
             if _mask_type_warning:
@@ -178,6 +189,11 @@ if _is_triton_available:
             if key_padding_mask is not None:
                 key_padding_mask = key_padding_mask.half()
 
+            if self.dense_layout:
+                return self._dense_attention(
+                    q, k, v, att_mask, key_padding_mask, scale
+                ).to(q_dtype)
+
             # Self-attend: (B, nh, S, hs) x (B, nh, hs, S) -> (B, nh, S, S)
             # When the computations are block sparse, the matrix types change along the way:
             # - (sparse) attention matrix = (dense) Kt * (dense) Q
@@ -199,3 +215,33 @@ if _is_triton_available:
             # - then (dense) attention is (sparse) attention matrix * dense (value)
             a = self.sparse_dot_dsd(sparse_att_mat, v)
             return a.to(q_dtype)
+
+        def _dense_attention(
+            self,
+            q: torch.Tensor,
+            k: torch.Tensor,
+            v: torch.Tensor,
+            att_mask: Optional[torch.Tensor],
+            key_padding_mask: Optional[torch.Tensor],
+            scale: float,
+        ) -> torch.Tensor:
+            # Same computation as the blocksparse path: the scale applies to the logits,
+            # the masks are additive.
+            # The dense attention expects [N, seq, hs], fold the heads into the batch
+            B, H, S, _ = q.shape
+            q, k, v = q.flatten(0, 1), k.flatten(0, 1), v.flatten(0, 1)
+
+            mask = att_mask
+            if key_padding_mask is not None:
+                # [B, seq] -> [B x H, 1, seq], same key mask for every head
+                kp_mask = (
+                    key_padding_mask[:, None, None, :]
+                    .expand(B, H, 1, S)
+                    .reshape(B * H, 1, S)
+                )
+                mask = kp_mask if mask is None else mask + kp_mask
+
+            a = scaled_dot_product_attention(
+                q * scale, k, v, att_mask=mask, dropout=self.attn_drop
+            )
+            return a.reshape(B, H, S, -1)